@@ -4,18 +4,27 @@ PPKを実行し、カメラの撮像位置を求める計算を実行する.
 """
 
 from datetime import datetime, timedelta, timezone
-from pandas import DataFrame, Series
-from numpy import nan, array, rad2deg, sqrt
+from pandas import DataFrame
+from numpy import array, rad2deg, deg2rad, sqrt, searchsorted, minimum, maximum, newaxis, stack, matmul, diagonal
+from numpy import ndarray, arange, tile, full, nan, isnan, nanmean, nanmin, nanargmin, zeros
 from os import environ
 from logging import getLogger
 from typing import Tuple
 from subprocess import STDOUT, Popen, PIPE
+from concurrent.futures import ThreadPoolExecutor
 
 ## 内製ライブラリ..
 import xgnss.rinex_pos as rnx_pos
-from xgnss.calc_xyz import xyz2llh, enu2xyz
+from xgnss.calc_xyz import xyz2llh, llh2xyz, xyzRenu_batch, enuRxyz_batch, cov_xyz2enu_batch
+from xgnss.fix_index import FixIndex
+from xgnss.base_select import BaseArchive
+import xgnss.rinex_obs as rnx_obs
+from xgnss.photo_geotag import write_geotags
 ### RTKLIBの後処理測位計算プログラム.
 POS_ACC_MIN = 0.030
+LAG_RANGE = (-1.0, 1.0) # [s] search range of shutter time lag
+LAG_STEP = 0.05 # [s] coarse step of shutter time lag search
+PRESCAN_MARGIN = 60.0 # [s] observations this long before/after the photos are scanned by prescan
 POST_RTKLIB_EXE = "rnx2rtkp" # Must be in $PATH
 RTKLIB_TEMPLATE_FILE = environ.get("PPK_EXTDIR", ".") + "/ext/rtklib/data/template-rnx2rtkp-conf.txt"
 
@@ -115,6 +124,124 @@ def _load_dji_timestamp_mrk(mrk_file:str) -> list:
     return dat
 
 
+def format_geotag_table(df_imgs:DataFrame) -> DataFrame:
+    """
+    Format numeric columns of geotag table as strings for CSV output.
+    """
+    df_imgs = df_imgs.copy()
+    for k in ["lat","lon"]:
+        df_imgs[k] = df_imgs[k].map(lambda x: '{0:.8f}'.format(x))
+    for k in ['hgt', "north_acc", "east_acc", "up_acc"]:
+        df_imgs[k] = df_imgs[k].map(lambda x: '{0:.4f}'.format(x))
+    df_imgs["time_since_fix"] = df_imgs["time_since_fix"].map(lambda x: '{0:.1f}'.format(x) if x == x else "")
+    return df_imgs
+
+
+def _camera_xyz(t_pos:ndarray, p_xyz:ndarray, P_xyz:ndarray, t_img:ndarray, dx_ned:ndarray) \
+    -> Tuple[ndarray, ndarray, ndarray]:
+    """
+    アンテナ位置を撮影時刻に補間し、アンテナ〜カメラ補正を適用したカメラ位置を求める (全写真を一括で計算).
+
+    Parameters
+    ----------
+    t_pos[N], p_xyz[N,3], P_xyz[N,3,3], time, position and covariance of PPK solution (rnx_pos.to_arrays)
+    t_img[M], shutter time [s]
+    dx_ned[M,3], antenna to camera vector in NED [m]
+    P_xyz is not interpolated if None.
+
+    Returns
+    -------
+    valid[M], True if t_img is between 2 epochs
+    p_img_xyz[K,3], camera position of valid photos in ECEF
+    P_img_xyz[K,3,3], covariance of camera position in ECEF (None if P_xyz is None)
+    """
+    ## Find 2 epochs around the shutter time (i1 < t < i2) for all photos
+    i2 = searchsorted(t_pos, t_img, side="right")
+    i2[(i2 > 0) & (t_pos[minimum(i2, len(t_pos)) - 1] == t_img)] = 0 # exactly on an epoch is not interpolated
+    valid = (i2 > 0) & (i2 < len(t_pos))
+    i2 = i2[valid]
+    i1 = i2 - 1
+    dt1, dt2 = t_img[valid] - t_pos[i1], t_pos[i2] - t_img[valid]
+    c1, c2 = dt2 / (dt1 + dt2), dt1 / (dt1 + dt2)
+    ## Interpolation of 2 points
+    p_ant_xyz = c1[:, newaxis] * p_xyz[i1] + c2[:, newaxis] * p_xyz[i2]
+    P_img_xyz = None
+    if P_xyz is not None:
+        P_img_xyz = (c1**2)[:, newaxis, newaxis] * P_xyz[i1] + (c2**2)[:, newaxis, newaxis] * P_xyz[i2]
+    p_llh = xyz2llh(p_ant_xyz.T)
+    ## Compensation vector
+    dx_ned = dx_ned[valid]
+    dx_enu = stack([dx_ned[:, 1], dx_ned[:, 0], -dx_ned[:, 2]], axis=1) # ned to enu
+    p_img_xyz = p_ant_xyz + matmul(xyzRenu_batch(p_llh[0], p_llh[1]), dx_enu[:, :, newaxis])[:, :, 0]
+    return valid, p_img_xyz, P_img_xyz
+
+
+def estimate_shutter_timelag(posdata:list, mrkdat:list, lag_range:Tuple[float, float] = LAG_RANGE,\
+                            lag_step:float = LAG_STEP, n_refine:int = 3, mrk_reference:str = "antenna", **kwargs) -> dict:
+    """
+    MRKファイルに記録された機上の位置とPPKで求めたカメラ位置を比較して、シャッタの遅れ時間を推定する.
+    候補の遅れ時間ごとに全写真の残差を一括で計算し、粗い刻みから細かい刻みへ探索する.
+    機上の位置(RTK/単独測位)の一定のずれは平均を除いて評価するため、
+    往復飛行などで速度が変化するフライトでないと遅れ時間は決まらない.
+    DJIのMRKの位置はアンテナ位置なので、既定ではアンテナ〜カメラ補正をしないPPKの位置と比較する.
+    (補正ベクトルは機首方位で向きが変わり、往復で符号が反転するため、補正したカメラ位置と比べると遅れ時間が偏る)
+
+    Parameters
+    ----------
+    posdata, list of epochs (rnx_pos.load)
+    mrkdat, list of timestamps (_load_dji_timestamp_mrk)
+    lag_range, (min, max) of searched time lag [s]
+    lag_step, step of the first (coarse) search [s]
+    n_refine, number of refinements. the step is divided by 10 for each refinement.
+    mrk_reference, "antenna" (MRK position is the antenna position) or "camera" (MRK position is the camera position)
+    t_pos, p_xyz, arrays from rnx_pos.to_arrays(posdata) if already computed
+
+    Returns
+    -------
+    result, dict (lag [s], rms [m] of residual, mean and std [m] of ENU residual, n: number of photos)
+    """
+    t_pos, p_xyz = kwargs.get("t_pos"), kwargs.get("p_xyz")
+    if t_pos is None or p_xyz is None:
+        t_pos, p_xyz, _ = rnx_pos.to_arrays(posdata)
+    t_mrk = array([ d['datetime'].timestamp() for d in mrkdat ])
+    if mrk_reference == "antenna":
+        dx_ned = zeros((len(mrkdat), 3))
+    elif mrk_reference == "camera":
+        dx_ned = array([ d['dx'] for d in mrkdat ]).reshape(-1, 3)
+    else:
+        raise ValueError("mrk_reference must be 'antenna' or 'camera': {}".format(mrk_reference))
+    p_mrk_llh = array([ d['llh'] for d in mrkdat ]).reshape(-1, 3)
+    p_mrk_llh[:, 0:2] = deg2rad(p_mrk_llh[:, 0:2])
+    p_mrk_xyz = array(llh2xyz([p_mrk_llh[:, 0], p_mrk_llh[:, 1], p_mrk_llh[:, 2]])).T
+    R_enu = enuRxyz_batch(p_mrk_llh[:, 0], p_mrk_llh[:, 1])
+
+    def _residuals(lags:ndarray):
+        ## all photos x all lags at once. residual is nan if the photo is out of the solution.
+        n_lag, n_img = len(lags), len(t_mrk)
+        t_img = (t_mrk[newaxis, :] - lags[:, newaxis]).ravel()
+        valid, p_img_xyz, _ = _camera_xyz(t_pos, p_xyz, None, t_img, tile(dx_ned, (n_lag, 1)))
+        dp = full((n_lag * n_img, 3), nan)
+        dp[valid] = p_img_xyz
+        dp = dp.reshape(n_lag, n_img, 3) - p_mrk_xyz
+        return matmul(R_enu[newaxis], dp[:, :, :, newaxis])[:, :, :, 0]
+
+    lo, hi, step = lag_range[0], lag_range[1], lag_step
+    for _ in range(n_refine + 1):
+        lags = arange(lo, hi + step * 0.5, step)
+        d_enu = _residuals(lags)
+        if isnan(d_enu).all():
+            raise ValueError("No photo is covered by the PPK solution.")
+        rms = sqrt(nanmean(((d_enu - nanmean(d_enu, axis=1, keepdims=True))**2).sum(axis=2), axis=1))
+        best = lags[nanargmin(rms)]
+        lo, hi, step = best - step, best + step, step * 0.1
+    if best <= lag_range[0] or best >= lag_range[1]:
+        _logger.warning("estimated shutter time lag {:.4f} s is at the edge of the search range {}".format(best, lag_range))
+    d_enu = _residuals(array([best]))[0]
+    d_enu = d_enu[~isnan(d_enu).any(axis=1)]
+    return {"lag": float(best), "rms": float(nanmin(rms)), "mean_enu": d_enu.mean(axis=0).tolist(),
+            "std_enu": d_enu.std(axis=0).tolist(), "n": len(d_enu)}
+
+
 def geotag_info_from_posfile_and_mrkfile(posfile:str, mrkfile:str, photo_basename:str, **kwargs) \
     -> Tuple[DataFrame, dict]:
     """
@@ -126,7 +253,9 @@ def geotag_info_from_posfile_and_mrkfile(posfile:str, mrkfile:str, photo_basenam
     mrkfile, DJI time stamp of PPK files(*Timestamp.MRK)
     photo_basename, photo files is refered by photo_basenameXXXX where XXXX is incrementing number.
     **kwargs, options
-    shutter_timelag, time delay of camera shutter from recorded time (milli-second)
+    shutter_timelag, time delay of camera shutter from recorded time (second), or "auto" to estimate it
+    mrk_reference, position recorded in MRK, "antenna" (default) or "camera" (see estimate_shutter_timelag)
+    formatted, if False, numeric columns are not formatted as strings (default: True)
 
     Returns
     -------
@@ -135,8 +264,9 @@ def geotag_info_from_posfile_and_mrkfile(posfile:str, mrkfile:str, photo_basenam
     """
 
     # input data
-    posdata = rnx_pos.load(posfile)
-    print("pos: {} ({})".format(posfile, len(posdata)))
+    fix_index = FixIndex()
+    posdata = rnx_pos.load(posfile, index=fix_index)
+    print("pos: {} ({}, fix rate {:.1%})".format(posfile, len(posdata), fix_index.fix_rate()))
     mrkdat = _load_dji_timestamp_mrk(mrkfile)
     print("mrk: {} ({})".format(mrkfile, len(mrkdat)))
     print("photo_baseaname={}".format(photo_basename))
@@ -149,51 +279,35 @@ def geotag_info_from_posfile_and_mrkfile(posfile:str, mrkfile:str, photo_basenam
     else:
         raise("Input Timestamp is empty")
 
-    def _find_close_epoch(t_in:datetime, posdata:list):
-        """
-        """
-        for i in range(len(posdata)-1):
-            d1 = posdata[i]["datetime"]
-            d2 = posdata[i+1]["datetime"]
-            dt1 =  (t_in - d1).total_seconds()
-            dt2 =  (d2 - t_in).total_seconds()
-            if dt1 > 0.0 and dt2 > 0.0:
-                return  i, i+1, dt1, dt2
-        return len(posdata)-1, None, nan, nan
-
-    df_imgs = DataFrame( index=[], columns=["name", "datetime", "lat", "lon", "hgt", "north_acc", "east_acc", "up_acc"] )
     shutter_timelag = kwargs.get("shutter_timelag", 0.0)
     #shutter_timelag = ppk_options.get("shutter_timelag", shutter_timelag)
     #data_name = path.splitext( path.basename(mrkfile) )[0][:-4]
     #photo_basename = "{}_{}".format( path.basename(mrkfile).split("_")[0], path.basename(mrkfile).split("_")[1] )
-    for d in mrkdat:
-        i1, i2, dt1, dt2 = _find_close_epoch(d['datetime'] - timedelta(seconds=shutter_timelag), posdata)
-        if i1 is None or i2 is None:
-            continue
-        c1, c2 = dt2 / (dt1 + dt2), dt1 / (dt1 + dt2)
-        ## Interpolation of 2 points
-        p1_xyz = array( [ posdata[i1]["X"], posdata[i1]["Y"], posdata[i1]["Z"] ] )
-        p2_xyz = array( [ posdata[i2]["X"], posdata[i2]["Y"], posdata[i2]["Z"] ] )
-        p_xyz = c1 * p1_xyz + c2 * p2_xyz
-        p_llh = xyz2llh(p_xyz)
-        ## Compensation vector
-        dx_enu = [d['dx'][1], d['dx'][0], -d['dx'][2]] # enu to ned
-        p_img_xyz = enu2xyz(dx_enu, p_xyz, p_llh[0], p_llh[1])
-        p_img_llh = xyz2llh(p_img_xyz)
-        ## Position Accuracy
-        p1_sig_enu = array( [ posdata[i1]["sdx"], posdata[i1]["sdy"], posdata[i1]["sdz"] ] )
-        p2_sig_enu = array( [ posdata[i2]["sdx"], posdata[i2]["sdy"], posdata[i2]["sdz"] ] )
-        sig_dx_enu = [ max(sqrt( (c1*p1_sig_enu[i])**2 + (c2*p2_sig_enu[i])**2 ), POS_ACC_MIN) for i in range(0, 3)]
-        pic_name = photo_basename + "{:04d}".format(int(d["pic_id"])) + kwargs.get("postfix","")
-        df_imgs = df_imgs.append(Series([pic_name, d['datetime'] - timedelta(seconds=shutter_timelag),\
-                        rad2deg(p_img_llh[0]), rad2deg(p_img_llh[1]), p_img_llh[2],\
-                        sig_dx_enu[0], sig_dx_enu[1], sig_dx_enu[2]], \
-                    index=df_imgs.columns), \
-                ignore_index=True)
-    for k in ["lat","lon"]:
-        df_imgs[k] = df_imgs[k].map(lambda x: '{0:.8f}'.format(x))
-    for k in ['hgt', "north_acc", "east_acc", "up_acc"]:
-        df_imgs[k] = df_imgs[k].map(lambda x: '{0:.4f}'.format(x))
+    t_pos, p_xyz, P_xyz = rnx_pos.to_arrays(posdata)
+    if shutter_timelag == "auto":
+        lag = estimate_shutter_timelag(posdata, mrkdat, mrk_reference=kwargs.get("mrk_reference", "antenna"), \
+            t_pos=t_pos, p_xyz=p_xyz)
+        print("shutter_timelag: {:.4f} s (rms {:.4f} m, {} photos)".format(lag["lag"], lag["rms"], lag["n"]))
+        shutter_timelag = lag["lag"]
+    t_img = array([ d['datetime'].timestamp() - shutter_timelag for d in mrkdat ])
+    dx_ned = array([ d['dx'] for d in mrkdat ]).reshape(-1, 3)
+    valid, p_img_xyz, P_xyz = _camera_xyz(t_pos, p_xyz, P_xyz, t_img, dx_ned)
+    p_img_llh = xyz2llh(p_img_xyz.T)
+    ## Position Accuracy (covariance is rotated to ENU at the camera position)
+    Q_enu = cov_xyz2enu_batch(P_xyz, p_img_llh[0], p_img_llh[1])
+    sig_enu = maximum(sqrt(diagonal(Q_enu, axis1=1, axis2=2)), POS_ACC_MIN)
+    ## Fix state at the shutter time
+    q_img, dt_fix = fix_index.q_and_time_since_fix(t_img[valid])
+    df_imgs = DataFrame({
+        "name": [ photo_basename + "{:04d}".format(int(d["pic_id"])) + kwargs.get("postfix","") \
+                    for d, v in zip(mrkdat, valid) if v ],
+        "datetime": [ d['datetime'] - timedelta(seconds=shutter_timelag) for d, v in zip(mrkdat, valid) if v ],
+        "lat": rad2deg(p_img_llh[0]), "lon": rad2deg(p_img_llh[1]), "hgt": p_img_llh[2],
+        "north_acc": sig_enu[:, 1], "east_acc": sig_enu[:, 0], "up_acc": sig_enu[:, 2],
+        "fix_state": q_img, "time_since_fix": dt_fix},
+        columns=["name", "datetime", "lat", "lon", "hgt", "north_acc", "east_acc", "up_acc", "fix_state", "time_since_fix"])
+    if kwargs.get("formatted", True):
+        df_imgs = format_geotag_table(df_imgs)
     df_imgs = df_imgs.sort_values(by="name")
     return df_imgs
 
@@ -211,6 +325,10 @@ def camera_geotagging_by_ppk(drone_rinex_file:str, ref_rinex_file:str, nav_rinex
     ref_dict, 基準局情報を格納したdictionary (TODO: 引数にする)
     timestampfile, タイムスタンプファイル
     photo_basename, 写真ファイルのbase name
+    **kwds, options
+    prescan, "off", "suggest" (表示のみ) or "apply": 観測値ファイルを事前に走査して除外衛星とSNRマスクを決める
+    prescan_jobs, 事前走査の並列数 (default: 2)
+    rover_scan, 走査済みのドローンの観測値 (rnx_obs.scan の結果). 与えた場合は基準局の観測値だけを走査する
 
     Returns
     -------
@@ -221,9 +339,28 @@ def camera_geotagging_by_ppk(drone_rinex_file:str, ref_rinex_file:str, nav_rinex
     rtklib_conffile = "{}/ppk.conf".format(work_dir)
     _out_posfile = "{}/out.pos".format(work_dir)
     rov_info = {"rcv": ""}
+    rtklib_opts = {"snrmask": 30}
+    prescan = kwds.get("prescan", "off")
+    if prescan in ["suggest", "apply"]:
+        t_start, t_end = _prescan_window(timestamp_file)
+        if kwds.get("rover_scan") is not None:
+            scans = [kwds["rover_scan"], rnx_obs.scan(ref_rinex_file, t_start, t_end)]
+        else:
+            scans = rnx_obs.scan_files([drone_rinex_file, ref_rinex_file], kwds.get("prescan_jobs", 2), t_start, t_end)
+        suggested = rnx_obs.suggest_options(scans)
+        for sc in scans:
+            print("prescan: {} ({} epochs, {} sats, interval {} s)".format(sc["file"], sc["n_epochs"], len(sc["sats"]), sc["interval"]))
+        for sv, r in suggested["reasons"].items():
+            print("  exclude {}: {}".format(sv, ", ".join(r)))
+        print("prescan: exclude_sats={} snrmask={} ({})".format(" ".join(suggested["exclude_sats"]), suggested["snrmask"], \
+            "applied" if prescan == "apply" else "not applied"))
+        if prescan == "apply":
+            rtklib_opts["snrmask"] = suggested["snrmask"]
+            if len(suggested["exclude_sats"]) > 0:
+                rtklib_opts["exclude_sats"] = suggested["exclude_sats"]
     _create_conffile(RTKLIB_TEMPLATE_FILE, rtklib_conffile, rov_info, ref_info, \
         use_glonass = True, use_galileo = True, use_qzss = True, use_compass = True, \
-        posmode = "kinematic", freq="l1+l2", armode="fix-and-hold", elmask=15, maxage=30.0, snrmask=30)
+        posmode = "kinematic", freq="l1+l2", armode="fix-and-hold", elmask=15, maxage=30.0, **rtklib_opts)
 #        posmode = "kinematic", freq="l1+l2", elmask=25, maxage=30.0, snrmask=33)
 
     cmd_str = "{post_rtk_exe} -k {conffile} {rov} {ref} {nav} -o {pos}".format(post_rtk_exe=POST_RTKLIB_EXE, \
@@ -241,10 +378,91 @@ def camera_geotagging_by_ppk(drone_rinex_file:str, ref_rinex_file:str, nav_rinex
 
     # TimeStampファイルをもとにアンテナカメラ補正、PPKの結果を時刻変換してカメラ位置を求める.
     _logger.info("Load {} and compensate camera-antenna position".format(timestamp_file))
-    df = geotag_info_from_posfile_and_mrkfile(_out_posfile, timestamp_file, photo_basename, postfix=kwds.get("postfix",""))
+    df = geotag_info_from_posfile_and_mrkfile(_out_posfile, timestamp_file, photo_basename, postfix=kwds.get("postfix",""), \
+        formatted=kwds.get("formatted", True), shutter_timelag=kwds.get("shutter_timelag", 0.0), \
+        mrk_reference=kwds.get("mrk_reference", "antenna"))
 
     return df
 
+def _prescan_window(timestamp_file:str) -> Tuple[float, float]:
+    """
+    観測値を事前走査する時間範囲 (撮影時間の前後 PRESCAN_MARGIN 秒). unix time [s]
+    """
+    mrkdat = _load_dji_timestamp_mrk(timestamp_file)
+    if len(mrkdat) == 0:
+        return None, None
+    return mrkdat[0]["datetime"].timestamp() - PRESCAN_MARGIN, mrkdat[-1]["datetime"].timestamp() + PRESCAN_MARGIN
+
+
+def _ppk_fix_rate(posfile:str, t_start:float, t_end:float) -> float:
+    """
+    PPKの解のうち、[t_start, t_end] のFIX率. 解が無い場合は -1.
+    """
+    fix_index = FixIndex()
+    if path.isfile(posfile):
+        rnx_pos.load(posfile, index=fix_index)
+    rate = fix_index.fix_rate(t_start, t_end)
+    return rate if rate == rate else -1.0
+
+
+def camera_geotagging_with_base_archive(drone_rinex_file:str, nav_rinex_file:str, base_archive_dir:str,\
+                            timestamp_file:str, photo_basename:str, n_candidates:int = 1, jobs:int = 1, **kwds) \
+    -> Tuple[DataFrame, dict]:
+    """
+    基準局のアーカイブから撮影範囲・時間に合う近い基準局を選んで camera_geotagging_by_ppk を実行する.
+    n_candidates > 1 の場合は近い順に複数の基準局でPPKを並列に実行し、FIX率が最も高い結果を返す.
+
+    Parameters
+    ----------
+    drone_rinex_file, ドローンのRINEX file(GNSS raw measurement)
+    nav_rinex_file, 衛星軌道情報のRINEX file
+    base_archive_dir, 基準局のRINEX観測値ファイルを置いたフォルダ
+    timestamp_file, タイムスタンプファイル
+    photo_basename, 写真ファイルのbase name
+    n_candidates, PPKを実行する基準局の数
+    jobs, 並列に実行するPPKの数
+
+    Returns
+    -------
+    df, 各写真のカメラ位置を格納した DataFrame
+    ref_info, 選択した基準局の情報
+    """
+    mrkdat = _load_dji_timestamp_mrk(timestamp_file)
+    if len(mrkdat) == 0:
+        raise ValueError("Input Timestamp is empty")
+    t_start, t_end = mrkdat[0]["datetime"].timestamp(), mrkdat[-1]["datetime"].timestamp()
+    p_llh = array([ d["llh"] for d in mrkdat ]).mean(axis=0)
+    archive = BaseArchive(base_archive_dir)
+    _logger.info("base archive {}: {} new files indexed".format(base_archive_dir, archive.update()))
+    candidates = archive.select(p_llh[0], p_llh[1], p_llh[2], t_start, t_end, n_candidates)
+    if len(candidates) == 0:
+        raise ValueError("No reference station in {} covers the timestamp file.".format(base_archive_dir))
+    work_dir = kwds.pop("work_dir", ".")
+    if kwds.get("prescan", "off") in ["suggest", "apply"]:
+        # ドローンの観測値は基準局によらないので、1回だけ走査する
+        kwds["rover_scan"] = rnx_obs.scan(drone_rinex_file, *_prescan_window(timestamp_file))
+
+    def _run(ref_info:dict):
+        _work_dir = "{}/{}".format(work_dir, ref_info["marker"])
+        makedirs(_work_dir, exist_ok=True)
+        try:
+            df = camera_geotagging_by_ppk(drone_rinex_file, ref_info["obsfile"], nav_rinex_file, ref_info,\
+                timestamp_file, photo_basename, work_dir=_work_dir, **kwds)
+        except Exception as e:
+            print("({}) {}: {}".format(__name__, ref_info["obsfile"], e))
+            return None, -1.0
+        return df, _ppk_fix_rate("{}/out.pos".format(_work_dir), t_start, t_end)
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        results = list(executor.map(_run, candidates))
+    for ref_info, (_, rate) in zip(candidates, results):
+        print("base: {} ({:.1f} km) fix rate {:.1%}".format(ref_info["marker"], ref_info["dist3d"] * 1E-3, rate))
+    i_best = max(range(len(candidates)), key=lambda i: results[i][1])
+    if results[i_best][0] is None:
+        raise ValueError("PPK failed with all reference stations.")
+    return results[i_best][0], candidates[i_best]
+
+
 from os import makedirs
 def main(args:dict):
     global RTKLIB_TEMPLATE_FILE
@@ -259,24 +477,76 @@ def main(args:dict):
     # 作業用フォルダを作成.
     _ppk_dir = "ppk_proc"
     makedirs(_ppk_dir, exist_ok=True)
-    # 基準局の情報
-    _pos = [ float(v) for v in args.relpos.split(",")]
-    ref_info = {'obsfile': args.ref_rnx_obs,
-            "lat":_pos[0], "lon":_pos[1], "ellipsed_alt":_pos[2],
-            'ant': "",
-            'ant_d': [0.0,0.0,0.0],
-            'rcv': "",
-            'dist3d': 0.0}
-    # 実行
-    df = camera_geotagging_by_ppk(\
-        args.rnx_obs, \
-        args.ref_rnx_obs, \
-        args.rnx_nav, \
-        ref_info,\
-        args.timestamp_file,
-        args.photo_file_prefix, work_dir=_ppk_dir, postfix=args.photo_file_postfix)
-    df.to_csv(args.out, index=False)
+    _timelag = args.shutter_timelag if args.shutter_timelag == "auto" else float(args.shutter_timelag)
+    if args.ref_rnx_obs == "auto":
+        # 基準局をアーカイブから選択して実行
+        if not args.base_archive:
+            print("ERROR: --base_archive is required when ref_rnx_obs is 'auto'.")
+            return -1
+        df, ref_info = camera_geotagging_with_base_archive(\
+            args.rnx_obs, \
+            args.rnx_nav, \
+            args.base_archive, \
+            args.timestamp_file,
+            args.photo_file_prefix, n_candidates=args.base_candidates, jobs=args.jobs, \
+            work_dir=_ppk_dir, postfix=args.photo_file_postfix, formatted=False, shutter_timelag=_timelag, \
+            mrk_reference=args.mrk_reference, prescan=args.prescan)
+        _ppk_dir = "{}/{}".format(_ppk_dir, ref_info["marker"])
+        print("base: {} ({})".format(ref_info["marker"], ref_info["obsfile"]))
+    else:
+        # 基準局の情報
+        if args.relpos == "auto":
+            hdr = rnx_obs.read_header(args.ref_rnx_obs)
+            _llh = xyz2llh(hdr["pos_xyz"])
+            _pos = [rad2deg(_llh[0]), rad2deg(_llh[1]), _llh[2]]
+        else:
+            _pos = [ float(v) for v in args.relpos.split(",")]
+        ref_info = {'obsfile': args.ref_rnx_obs,
+                "lat":_pos[0], "lon":_pos[1], "ellipsed_alt":_pos[2],
+                'ant': "",
+                'ant_d': [0.0,0.0,0.0],
+                'rcv': "",
+                'dist3d': 0.0}
+        # 実行
+        df = camera_geotagging_by_ppk(\
+            args.rnx_obs, \
+            args.ref_rnx_obs, \
+            args.rnx_nav, \
+            ref_info,\
+            args.timestamp_file,
+            args.photo_file_prefix, work_dir=_ppk_dir, postfix=args.photo_file_postfix, formatted=False, \
+            shutter_timelag=_timelag, mrk_reference=args.mrk_reference, prescan=args.prescan)
+    format_geotag_table(df).to_csv(args.out, index=False)
     print("out:{} ({})".format(args.out, len(df)))
+    if args.photo_dir:
+        summary = write_geotags(df, args.photo_dir, jobs=args.photo_jobs)
+        print("photo: {} (written {}/{}, xmp {})".format(args.photo_dir, summary["ok"], summary["total"], summary["xmp"]))
+        for k, v in summary.items():
+            if k.endswith("_files") or (k == "unmatched" and len(v) > 0):
+                print("  {}: {}".format(k, " ".join(v)))
+    if args.columnar_out:
+        _write_columnar(args.columnar_out, args.columnar_format, _ppk_dir, df, ref_info, \
+            {"rover_obs": args.rnx_obs, "ref_obs": ref_info["obsfile"], "nav": args.rnx_nav, \
+             "timestamp": args.timestamp_file})
+
+
+def _write_columnar(out_prefix:str, fmt:str, work_dir:str, df_imgs:DataFrame, ref_info:dict, input_files:dict):
+    """
+    PPKの解とgeotag結果を列指向フォーマットで出力する.
+    {out_prefix}_pos.{fmt} と {out_prefix}_geotag.{fmt} を作成する.
+    """
+    import xgnss.columnar as columnar
+    _posfile = "{}/out.pos".format(work_dir)
+    _conffile = "{}/ppk.conf".format(work_dir)
+    with open(_conffile) as f:
+        _conf = [l.strip() for l in f if l.strip() != "" and l[0] != "#"]
+    meta = columnar.make_metadata({"rtklib_conf": _conf, "ref_info": ref_info}, \
+        dict(input_files, pos=_posfile))
+    ext = columnar.FORMATS[fmt]
+    n = columnar.write_pos(rnx_pos.load(_posfile), out_prefix + "_pos" + ext, meta, fmt)
+    print("out:{} ({})".format(out_prefix + "_pos" + ext, n))
+    n = columnar.write_geotag(df_imgs, out_prefix + "_geotag" + ext, meta, fmt)
+    print("out:{} ({})".format(out_prefix + "_geotag" + ext, n))
 
 
 if __name__ == "__main__":
@@ -288,12 +558,32 @@ if __name__ == "__main__":
     )
     parser.add_argument("rnx_obs", help="RINEX observation file (*.obs)", type=str)
     parser.add_argument("rnx_nav", help="RINEX navigation file (*.nav)", type=str)
-    parser.add_argument("ref_rnx_obs", help="RINEX observation file of reference station (*.obs)", type=str)
+    parser.add_argument("ref_rnx_obs", help="RINEX observation file of reference station (*.obs), " \
+        + "or 'auto' to select from --base_archive", type=str)
     parser.add_argument("timestamp_file", help="Camera offset file in DJI PPK file format (*.MRK)", type=str)
-    parser.add_argument("relpos", help="Reference station position (e.g., 35.657204659,140.048099674,43.7597)", type=str)
+    parser.add_argument("relpos", help="Reference station position (e.g., 35.657204659,140.048099674,43.7597), " \
+        + "or 'auto' to use APPROX POSITION XYZ in RINEX header", type=str)
     parser.add_argument("--out", help="output camera position CSV file", default="camera_ref.csv")
     parser.add_argument("--photo_file_prefix", help="photo file prefix", default="image_0001_", type=str, required=False)
     parser.add_argument("--photo_file_postfix", help="photo file prefix", default=".JPG", type=str, required=False)
+    parser.add_argument("--base_archive", help="folder of reference station RINEX files (used if ref_rnx_obs is 'auto')", \
+        default="", type=str, required=False)
+    parser.add_argument("--base_candidates", help="number of nearest reference stations tried by PPK", \
+        default=1, type=int, required=False)
+    parser.add_argument("--jobs", help="number of PPK processes run in parallel", default=1, type=int, required=False)
+    parser.add_argument("--shutter_timelag", help="time delay of camera shutter [s], or 'auto' to estimate from MRK positions", \
+        default="0.0", type=str, required=False)
+    parser.add_argument("--mrk_reference", help="position recorded in MRK, used by --shutter_timelag=auto", \
+        default="antenna", choices=["antenna", "camera"], required=False)
+    parser.add_argument("--prescan", help="scan RINEX observations before PPK to suggest or apply excluded satellites and snrmask", \
+        default="off", choices=["off", "suggest", "apply"], required=False)
+    parser.add_argument("--photo_dir", help="folder of photos to write camera positions into EXIF/XMP", \
+        default="", type=str, required=False)
+    parser.add_argument("--photo_jobs", help="number of threads writing photos", default=8, type=int, required=False)
+    parser.add_argument("--columnar_out", help="prefix of columnar outputs of PPK solution and camera positions", \
+        default="", type=str, required=False)
+    parser.add_argument("--columnar_format", help="format of columnar outputs (requires pyarrow)", \
+        default="parquet", choices=["parquet", "arrow"], required=False)
     parser.add_argument("--rtklib_template_file", help="template of RTKLIB conf file", \
         default="conf/template-rnx2rtkp-conf.txt", type=str, required=False)
     args = parser.parse_args()
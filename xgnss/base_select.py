@@ -0,0 +1,114 @@
+"""
+基準局の観測値ファイルのアーカイブから、PPKに使用する基準局を選択するためのプログラム.
+
+アーカイブ内のRINEX観測値ファイルのヘッダから局の位置と観測時間を読み、
+index (base_index.json) に保存します. 2回目以降は追加・更新されたファイルだけを読みます.
+"""
+from glob import glob
+from json import dump, load as json_load
+from os import path, replace, stat
+from typing import List
+from numpy import array, deg2rad, rad2deg, sqrt, argsort
+
+import xgnss.rinex_obs as rnx_obs
+from xgnss.calc_xyz import llh2xyz, xyz2llh
+
+INDEX_FILE = "base_index.json"
+OBS_PATTERNS = ["*.obs", "*.??o", "*.??O", "*.rnx"]
+
+
+class BaseArchive:
+    """
+    Index of reference station observation files.
+
+    archive = BaseArchive("cors_dir")
+    archive.update()
+    candidates = archive.select(lat, lon, hgt, t_start, t_end, n=3)
+    """
+
+    def __init__(self, archive_dir: str, index_file: str = None):
+        self.archive_dir = archive_dir
+        self.index_file = index_file or path.join(archive_dir, INDEX_FILE)
+        self._files = {}
+        if path.isfile(self.index_file):
+            with open(self.index_file) as f:
+                self._files = json_load(f)
+
+    def update(self, patterns: List[str] = OBS_PATTERNS) -> int:
+        """
+        Read headers of new or changed observation files in the archive (recursively).
+
+        Returns
+        -------
+        number of (re)indexed files
+        """
+        obs_files = set()
+        for p in patterns:
+            obs_files |= set(glob(path.join(self.archive_dir, "**", p), recursive=True))
+        n = 0
+        files = {}
+        for obs_file in sorted(obs_files):
+            key = path.relpath(obs_file, self.archive_dir)
+            st = stat(obs_file)
+            e = self._files.get(key)
+            if e is None or e["size"] != st.st_size or e["mtime"] != st.st_mtime:
+                try:
+                    hdr = rnx_obs.read_header(obs_file)
+                    t_first, t_last = rnx_obs.epoch_range(obs_file, hdr)
+                except Exception as ex:
+                    print("base_select: skip {} ({})".format(obs_file, ex))
+                    continue
+                if t_first is None or t_last is None or hdr["pos_xyz"] == [0.0, 0.0, 0.0]:
+                    continue
+                e = {"size": st.st_size, "mtime": st.st_mtime,
+                     "marker": hdr["marker"], "rcv": hdr["rcv"], "ant": hdr["ant"], "ant_d": hdr["ant_d"],
+                     "pos_xyz": hdr["pos_xyz"], "t_first": t_first.timestamp(), "t_last": t_last.timestamp()}
+                n += 1
+            files[key] = e
+        self._files = files
+        tmp = self.index_file + ".tmp"
+        with open(tmp, "w") as f:
+            dump(self._files, f, indent=1)
+        replace(tmp, self.index_file)
+        return n
+
+    def __len__(self):
+        return len(self._files)
+
+    def select(self, lat: float, lon: float, hgt: float, t_start: float, t_end: float, n: int = 1) -> List[dict]:
+        """
+        Nearest stations whose observation covers [t_start, t_end].
+
+        Args
+        ----
+        lat, lon: position of the flight [deg]
+        hgt: ellipsoidal height of the flight [m]
+        t_start, t_end: unix time [s] of the flight (first and last photo)
+        n: maximum number of stations returned
+
+        Returns
+        -------
+        list of ref_info dict (obsfile, marker, lat, lon, ellipsed_alt, ant, ant_d, rcv, rcv_type, dist3d),
+        one per station (marker), sorted by distance.
+        rcv is left empty as in main() since the rover receiver type is unknown.
+        """
+        keys = [k for k, e in self._files.items() if e["t_first"] <= t_start and e["t_last"] >= t_end]
+        if len(keys) == 0:
+            return []
+        p_xyz = array([self._files[k]["pos_xyz"] for k in keys])
+        p0_xyz = array(llh2xyz([deg2rad(lat), deg2rad(lon), hgt]))
+        dist = sqrt(((p_xyz - p0_xyz)**2).sum(axis=1))
+        p_llh = xyz2llh(p_xyz.T)
+        ret, markers = [], set()
+        for i in argsort(dist):
+            e = self._files[keys[i]]
+            marker = e["marker"] or keys[i]
+            if marker in markers:
+                continue
+            markers.add(marker)
+            ret.append({"obsfile": path.join(self.archive_dir, keys[i]), "marker": marker,
+                        "lat": rad2deg(p_llh[0][i]), "lon": rad2deg(p_llh[1][i]), "ellipsed_alt": p_llh[2][i],
+                        "ant": e["ant"], "ant_d": e["ant_d"], "rcv": "", "rcv_type": e["rcv"], "dist3d": dist[i]})
+            if len(ret) >= n:
+                break
+        return ret
@@ -8,6 +8,7 @@ and LLH (latitude,longitude and height)
 """
 
 from numpy import sin,cos,arctan2,sqrt,array,dot,deg2rad,rad2deg
+from numpy import zeros,matmul
 from numpy import ndarray
 from typing import List
 
@@ -84,6 +85,77 @@ def xyzRenu(base_lat, base_lon):
         [0.0,       c2, s2]])
 
 
+def enuRxyz_batch(base_lat:ndarray, base_lon:ndarray) -> ndarray:
+    """
+    Rotation matrices from XYZ coordinate to Local Tangent Coordinate for many points.
+
+    Args
+    ----
+    base_lat: ndarray[N], latitude in radian
+    base_lon: ndarray[N], longitude in radian
+
+    Return
+    ------
+    R: ndarray[N,3,3], rotation matrices (p_enu[n] = R[n] * p_xyz[n])
+    """
+    s1, c1 = sin(base_lon), cos(base_lon)
+    s2, c2 = sin(base_lat), cos(base_lat)
+    R = zeros((len(s1), 3, 3))
+    R[:, 0, 0], R[:, 0, 1] = -s1, c1
+    R[:, 1, 0], R[:, 1, 1], R[:, 1, 2] = -c1 * s2, -s1 * s2, c2
+    R[:, 2, 0], R[:, 2, 1], R[:, 2, 2] = c1 * c2, s1 * c2, s2
+    return R
+
+
+def xyzRenu_batch(base_lat:ndarray, base_lon:ndarray) -> ndarray:
+    """
+    Rotation matrices from ENU to XYZ coordinates for many points.
+
+    Args
+    ----
+    base_lat, base_lon: ndarray[N], latitude and longitude [rad]
+
+    Return
+    ------
+    R: ndarray[N,3,3], rotation matrices (p_xyz[n] = R[n] * p_enu[n])
+    """
+    return enuRxyz_batch(base_lat, base_lon).transpose(0, 2, 1)
+
+
+def cov_enu2xyz(Q_enu:ndarray, lat:float, lon:float) -> ndarray:
+    """
+    Convert 3x3 covariance in ENU coordinate to ECEF.
+
+    Args
+    ----
+    Q_enu[3,3]: covariance in ENU [m^2]
+    lat, lon: latitude and longitude of the origin of ENU [rad]
+
+    Returns
+    -------
+    P_xyz[3,3]: covariance in ECEF [m^2]
+    """
+    R = xyzRenu(lat, lon)
+    return dot(dot(R, Q_enu), R.T)
+
+
+def cov_xyz2enu_batch(P_xyz:ndarray, lat:ndarray, lon:ndarray) -> ndarray:
+    """
+    Convert 3x3 covariances in ECEF to ENU coordinate for many points.
+
+    Args
+    ----
+    P_xyz[N,3,3]: covariance in ECEF [m^2]
+    lat, lon: ndarray[N], latitude and longitude of the origin of ENU [rad]
+
+    Returns
+    -------
+    Q_enu[N,3,3]: covariance in ENU [m^2]
+    """
+    R = enuRxyz_batch(lat, lon)
+    return matmul(matmul(R, P_xyz), R.transpose(0, 2, 1))
+
+
 def xyz2enu(p_xyz, p_base_xyz, lat, lon):
     """ Convert position in XYZ coordinate to ENU coordinate
 
@@ -0,0 +1,163 @@
+"""
+PPKの解(POS)やgeotag結果を列指向フォーマット(Parquet / Arrow IPC)で読み書きするためのプログラム.
+
+pyarrow が必要です (python -m pip install pyarrow).
+"""
+from datetime import datetime, timezone
+from hashlib import sha256
+from json import dumps, loads
+from os import path
+from typing import Tuple
+
+from pandas import DataFrame
+
+CHUNK_ROWS = 65536 # rows per row group (parquet) / record batch (arrow)
+FORMATS = {"parquet": ".parquet", "arrow": ".arrow"}
+
+POS_COLUMNS = ["datetime", "gpsweek", "gpstow", "X", "Y", "Z", "Q", "nsat",
+               "cvx", "cvy", "cvz", "cvxy", "cvyz", "cvzx", "age", "ratio"]
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        import pyarrow.ipc
+    except ImportError:
+        raise ImportError("columnar export requires pyarrow (python -m pip install pyarrow)")
+    return pyarrow
+
+
+def file_sha256(filepath: str) -> str:
+    """
+    SHA-256 hex digest of the file. Returns "" if the file does not exist.
+    """
+    if not path.isfile(filepath):
+        return ""
+    h = sha256()
+    with open(filepath, "rb") as f:
+        for b in iter(lambda: f.read(1 << 20), b""):
+            h.update(b)
+    return h.hexdigest()
+
+
+def make_metadata(ppk_config: dict = None, input_files: dict = None) -> dict:
+    """
+    Create metadata stored with the table.
+
+    Args
+    ----
+    ppk_config: dict, PPK options (e.g. RTKLIB conf file contents, reference station info)
+    input_files: dict, {label: file path}. SHA-256 of each file is recorded.
+    """
+    input_files = input_files or {}
+    return {"ppk_config": ppk_config or {},
+            "input_files": {k: path.basename(v) for k, v in input_files.items()},
+            "input_sha256": {k: file_sha256(v) for k, v in input_files.items()},
+            "created": datetime.now(tz=timezone.utc).isoformat()}
+
+
+def _pos_schema(pa, metadata: dict):
+    f64 = pa.float64()
+    fields = [pa.field("datetime", pa.timestamp("us", tz="UTC")),
+              pa.field("gpsweek", pa.int16()), pa.field("gpstow", f64),
+              pa.field("X", f64), pa.field("Y", f64), pa.field("Z", f64),
+              pa.field("Q", pa.int8()), pa.field("nsat", pa.int16())] \
+        + [pa.field(k, f64) for k in ["cvx", "cvy", "cvz", "cvxy", "cvyz", "cvzx", "age", "ratio"]]
+    return pa.schema(fields, metadata={"xgnss": dumps(metadata, default=str)})
+
+
+def _open_writer(pa, filepath: str, schema, fmt: str):
+    if fmt == "parquet":
+        return pa.parquet.ParquetWriter(filepath, schema, compression="zstd")
+    elif fmt == "arrow":
+        return pa.ipc.new_file(filepath, schema)
+    raise ValueError("unknown columnar format: {}".format(fmt))
+
+
+def write_pos(pos_epoch_list: list, filepath: str, metadata: dict = None, fmt: str = "parquet",
+              chunk_rows: int = CHUNK_ROWS) -> int:
+    """
+    Write epochs returned by rinex_pos.load() as a columnar table.
+
+    Args
+    ----
+    pos_epoch_list: list of epoch dict
+    filepath: output file path
+    metadata: dict, see make_metadata()
+    fmt: "parquet" or "arrow" (Arrow IPC file)
+    chunk_rows: number of epochs written at once
+
+    Returns
+    -------
+    number of written epochs
+    """
+    pa = _pyarrow()
+    schema = _pos_schema(pa, metadata or {})
+    writer = _open_writer(pa, filepath, schema, fmt)
+    try:
+        for i0 in range(0, len(pos_epoch_list), chunk_rows):
+            chunk = pos_epoch_list[i0:i0 + chunk_rows]
+            cols = [[e[k] for e in chunk] for k in POS_COLUMNS]
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(c, type=f.type) for c, f in zip(cols, schema)], schema=schema))
+    finally:
+        writer.close()
+    return len(pos_epoch_list)
+
+
+def write_geotag(df_imgs: DataFrame, filepath: str, metadata: dict = None, fmt: str = "parquet",
+                 chunk_rows: int = CHUNK_ROWS) -> int:
+    """
+    Write geotag table (numeric, not formatted for CSV) as a columnar table.
+
+    Args
+    ----
+    df_imgs: DataFrame from geotag_info_from_posfile_and_mrkfile(..., formatted=False)
+    filepath: output file path
+    metadata: dict, see make_metadata()
+    fmt: "parquet" or "arrow" (Arrow IPC file)
+    chunk_rows: number of rows written at once
+
+    Returns
+    -------
+    number of written rows
+    """
+    pa = _pyarrow()
+    table = pa.Table.from_pandas(df_imgs, preserve_index=False)
+    schema = table.schema.with_metadata({"xgnss": dumps(metadata or {}, default=str)})
+    table = table.replace_schema_metadata(schema.metadata)
+    writer = _open_writer(pa, filepath, schema, fmt)
+    try:
+        for batch in table.to_batches(max_chunksize=chunk_rows):
+            writer.write_table(pa.Table.from_batches([batch], schema=schema))
+    finally:
+        writer.close()
+    return table.num_rows
+
+
+def read_table(filepath: str, columns: list = None) -> Tuple[DataFrame, dict]:
+    """
+    Read table written by write_pos() / write_geotag().
+    The format is decided from the file extension (*.parquet or *.arrow).
+
+    Args
+    ----
+    filepath: input file path
+    columns: list of column names to read (None: all)
+
+    Returns
+    -------
+    df, DataFrame with native dtypes
+    metadata, dict stored with the table
+    """
+    pa = _pyarrow()
+    if filepath.endswith(FORMATS["arrow"]):
+        with pa.memory_map(filepath) as source:
+            table = pa.ipc.open_file(source).read_all()
+        if columns is not None:
+            table = table.select(columns)
+    else:
+        table = pa.parquet.read_table(filepath, columns=columns)
+    meta = (table.schema.metadata or {}).get(b"xgnss", b"{}")
+    return table.to_pandas(), loads(meta)
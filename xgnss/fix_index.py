@@ -0,0 +1,166 @@
+"""
+PPKの解の品質(Q)の区間インデックス.
+
+連続した同じQのエポックを1つの区間(run)にまとめて保持し(エポック間隔の1.5倍を超える途切れで区切る)、
+ある時刻のQ、FIXが継続している時間、期間内のFIX率などを二分探索で求める.
+"""
+from bisect import bisect_left, bisect_right
+from typing import List, Tuple
+from numpy import array, asarray, searchsorted, minimum, maximum, where, full, nan, ndarray, cumsum, concatenate, diff, median
+
+Q_FIX = 1
+Q_NONE = 0 # no solution
+GAP_FACTOR = 1.5 # runs are separated if epochs are apart more than GAP_FACTOR x median interval
+
+
+class FixIndex:
+    """
+    Run-length index of Q/ratio/nsat over the epochs of PPK solution.
+
+    Epochs are added in time order by append() (rinex_pos.load(..., index=FixIndex())).
+    Runs are built at the first query after append(). If max_gap is not given,
+    it is derived from the epoch interval of the solution.
+    """
+
+    def __init__(self, max_gap: float = None):
+        self._max_gap = max_gap
+        # epochs
+        self._t, self._q, self._ratio, self._nsat = [], [], [], []
+        # runs (built by _build)
+        self._runs = None
+        self._frozen = None
+
+    def append(self, t: float, q: int, ratio: float, nsat: int):
+        """
+        Add one epoch. t is unix time [s] and must be later than the last epoch.
+        """
+        if len(self._t) > 0 and t <= self._t[-1]:
+            return
+        self._t.append(t)
+        self._q.append(q)
+        self._ratio.append(ratio)
+        self._nsat.append(nsat)
+        self._runs = None
+        self._frozen = None
+
+    @classmethod
+    def from_epochs(cls, pos_epoch_list: list, max_gap: float = None):
+        """
+        Build index from epochs returned by rinex_pos.load().
+        """
+        index = cls(max_gap)
+        for e in pos_epoch_list:
+            index.append(e['datetime'].timestamp(), e['Q'], e['ratio'], e['nsat'])
+        return index
+
+    @property
+    def max_gap(self) -> float:
+        """
+        Maximum time [s] between epochs in one run (computed once by _build).
+        """
+        return self._build()[6]
+
+    def _build(self):
+        if self._runs is not None:
+            return self._runs
+        if self._max_gap is not None:
+            max_gap = self._max_gap
+        else:
+            max_gap = GAP_FACTOR * float(median(diff(self._t))) if len(self._t) >= 2 else 0.0
+        start, end, q_run, n, ratio_min, nsat_min = [], [], [], [], [], []
+        for t, q, ratio, nsat in zip(self._t, self._q, self._ratio, self._nsat):
+            if len(q_run) > 0 and q_run[-1] == q and t - end[-1] <= max_gap:
+                end[-1] = t
+                n[-1] += 1
+                ratio_min[-1] = min(ratio_min[-1], ratio)
+                nsat_min[-1] = min(nsat_min[-1], nsat)
+            else:
+                start.append(t)
+                end.append(t)
+                q_run.append(q)
+                n.append(1)
+                ratio_min.append(ratio)
+                nsat_min.append(nsat)
+        self._runs = (start, end, q_run, n, ratio_min, nsat_min, max_gap)
+        return self._runs
+
+    def _arrays(self):
+        if self._frozen is None:
+            start, end, q_run, _, _, _, max_gap = self._build()
+            fixed = [1 if q == Q_FIX else 0 for q in self._q]
+            self._frozen = (array(start), array(end), array(q_run), concatenate([[0], cumsum(fixed)]), max_gap)
+        return self._frozen
+
+    def __len__(self):
+        return len(self._build()[0])
+
+    def runs(self) -> List[dict]:
+        """
+        List of runs (start, end, Q, number of epochs, minimum ratio and nsat).
+        """
+        return [{"start": s, "end": e, "Q": q, "n": n, "ratio_min": r, "nsat_min": ns}
+                for s, e, q, n, r, ns in zip(*self._build()[0:6])]
+
+    def q_at(self, t: float) -> int:
+        """
+        Quality at time t. Between 2 runs, the worse (larger) Q is returned.
+        Q_NONE is returned out of the solution or in a data gap.
+        """
+        return int(self.q_and_time_since_fix(array([t]))[0][0])
+
+    def is_fixed(self, t: float) -> bool:
+        return self.q_at(t) == Q_FIX
+
+    def time_since_fix(self, t: float) -> float:
+        """
+        Time [s] since the fixed run containing t has started. nan if not fixed at t.
+        """
+        return float(self.q_and_time_since_fix(array([t]))[1][0])
+
+    def q_and_time_since_fix(self, t: ndarray) -> Tuple[ndarray, ndarray]:
+        """
+        Quality and time since fix for many times at once.
+
+        Args
+        ----
+        t[N]: unix time [s]
+
+        Returns
+        -------
+        q[N]: quality (see q_at)
+        dt[N]: time since fix [s] (nan if not fixed)
+        """
+        start, end, q_run, _, max_gap = self._arrays()
+        t = asarray(t, dtype=float)
+        q, dt = full(len(t), Q_NONE), full(len(t), nan)
+        if len(start) == 0:
+            return q, dt
+        k = searchsorted(start, t, side="right") - 1
+        kc = maximum(k, 0)
+        kn = minimum(kc + 1, len(start) - 1)
+        inside = (k >= 0) & (t <= end[kc])
+        between = (k >= 0) & ~inside & (kc + 1 < len(start)) & (start[kn] - end[kc] <= max_gap)
+        q = where(inside, q_run[kc], q)
+        q = where(between, maximum(q_run[kc], q_run[kn]), q)
+        dt = where(inside & (q_run[kc] == Q_FIX), t - start[kc], dt)
+        return q, dt
+
+    def fixed_intervals(self, t1: float = None, t2: float = None) -> List[Tuple[float, float]]:
+        """
+        Fixed runs (start, end) overlapping [t1, t2].
+        """
+        start, end, q_run, _, _, _, _ = self._build()
+        k1 = 0 if t1 is None else bisect_left(end, t1)
+        k2 = len(start) if t2 is None else bisect_right(start, t2)
+        return [(start[k], end[k]) for k in range(k1, k2) if q_run[k] == Q_FIX]
+
+    def fix_rate(self, t1: float = None, t2: float = None) -> float:
+        """
+        Ratio of fixed epochs in [t1, t2] (whole solution if not given). nan if no epoch.
+        """
+        _, _, _, cum_fixed, _ = self._arrays()
+        i1 = 0 if t1 is None else bisect_left(self._t, t1)
+        i2 = len(self._t) if t2 is None else bisect_right(self._t, t2)
+        if i2 <= i1:
+            return nan
+        return float(cum_fixed[i2] - cum_fixed[i1]) / (i2 - i1)
@@ -0,0 +1,245 @@
+"""
+写真(JPEG)のEXIF/XMPにカメラ位置を書き込むためのプログラム.
+
+JPEGのヘッダ(APP1セグメント)だけを読み、既存のEXIF GPSタグとXMPの属性の値を
+同じ大きさで上書きします. 画像データの再エンコードやファイルのコピーは行いません.
+そのため、EXIFにGPSタグが無い写真や、XMPの空き(padding)が足りない写真には書き込めません.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from os import path, listdir
+from re import compile as re_compile, escape
+from struct import pack, unpack_from
+from typing import Tuple
+from pandas import DataFrame
+
+EXIF_HEADER = b"Exif\x00\x00"
+XMP_HEADER = b"http://ns.adobe.com/xap/1.0/\x00"
+XMP_PREFIX = "drone-dji"
+XMP_NS = "http://www.dji.com/drone-dji/1.0/"
+XMP_ALIASES = {"GpsLongitude": "GpsLongtitude"} # spelling used by some DJI firmwares
+# EXIF GPS IFD tags
+GPS_IFD_POINTER = 0x8825
+GPS_LAT_REF, GPS_LAT, GPS_LON_REF, GPS_LON, GPS_ALT_REF, GPS_ALT = 1, 2, 3, 4, 5, 6
+GPS_H_POS_ERR = 0x1F
+_TYPE_SIZE = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8}
+
+STATUS_OK = "ok"
+STATUS_MISSING = "missing"   # photo file not found
+STATUS_NO_EXIF = "no_exif"   # not a JPEG or no EXIF segment
+STATUS_NO_GPS = "no_gps"     # no GPS IFD or required GPS tags
+STATUS_ERROR = "error"
+
+
+def _read_app1_segments(f) -> Tuple[tuple, tuple]:
+    """
+    Read APP1 segments until start of scan.
+
+    Returns
+    -------
+    (offset, data) of EXIF and XMP segment (None if not found). offset is the file position of data.
+    """
+    exif, xmp = None, None
+    if f.read(2) != b"\xff\xd8":
+        return exif, xmp
+    while True:
+        b = f.read(2)
+        if len(b) < 2 or b[0] != 0xFF:
+            break
+        marker = b[1]
+        while marker == 0xFF: # fill bytes
+            marker = f.read(1)[0]
+        if marker == 0xD8 or marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            continue
+        if marker == 0xDA or marker == 0xD9: # start of scan / end of image
+            break
+        length = unpack_from(">H", f.read(2))[0]
+        offset = f.tell()
+        if marker == 0xE1:
+            data = f.read(length - 2)
+            if exif is None and data.startswith(EXIF_HEADER):
+                exif = (offset, bytearray(data))
+            elif xmp is None and data.startswith(XMP_HEADER):
+                xmp = (offset, bytearray(data))
+        else:
+            f.seek(length - 2, 1)
+    return exif, xmp
+
+
+def _rational_dms(v: float) -> list:
+    """
+    Degree to [(deg, 1), (min, 1), (sec * 1E6, 1E6)]
+    """
+    v = abs(v)
+    d = int(v)
+    m = int((v - d) * 60.0)
+    s = ((v - d) * 60.0 - m) * 60.0
+    return [(d, 1), (m, 1), (int(round(s * 1E6)), 1000000)]
+
+
+def _patch_exif_gps(data: bytearray, lat: float, lon: float, hgt: float, hacc: float = None) -> bool:
+    """
+    Overwrite GPS tags in EXIF segment data in place.
+    Returns False if GPS IFD or one of the position tags is not found.
+    """
+    tiff = len(EXIF_HEADER)
+    bo = "<" if data[tiff:tiff + 2] == b"II" else ">"
+
+    def _ifd(ofs: int) -> dict:
+        entries = {}
+        n = unpack_from(bo + "H", data, tiff + ofs)[0]
+        for i in range(n):
+            pos = tiff + ofs + 2 + 12 * i
+            tag, typ, cnt = unpack_from(bo + "HHI", data, pos)
+            size = _TYPE_SIZE.get(typ, 1) * cnt
+            vpos = pos + 8 if size <= 4 else tiff + unpack_from(bo + "I", data, pos + 8)[0]
+            entries[tag] = (typ, cnt, vpos)
+        return entries
+
+    ifd0 = _ifd(unpack_from(bo + "I", data, tiff + 4)[0])
+    if GPS_IFD_POINTER not in ifd0:
+        return False
+    gps = _ifd(unpack_from(bo + "I", data, ifd0[GPS_IFD_POINTER][2])[0])
+    required = {GPS_LAT_REF: (2, 2), GPS_LAT: (5, 3), GPS_LON_REF: (2, 2), GPS_LON: (5, 3),
+                GPS_ALT_REF: (1, 1), GPS_ALT: (5, 1)}
+    for tag, (typ, cnt) in required.items():
+        if tag not in gps or gps[tag][0:2] != (typ, cnt):
+            return False
+
+    def _put_rationals(tag: int, values: list):
+        vpos = gps[tag][2]
+        for i, (num, den) in enumerate(values):
+            data[vpos + 8 * i: vpos + 8 * i + 8] = pack(bo + "II", num, den)
+
+    data[gps[GPS_LAT_REF][2]:gps[GPS_LAT_REF][2] + 2] = b"N\x00" if lat >= 0 else b"S\x00"
+    _put_rationals(GPS_LAT, _rational_dms(lat))
+    data[gps[GPS_LON_REF][2]:gps[GPS_LON_REF][2] + 2] = b"E\x00" if lon >= 0 else b"W\x00"
+    _put_rationals(GPS_LON, _rational_dms(lon))
+    data[gps[GPS_ALT_REF][2]] = 0 if hgt >= 0 else 1
+    _put_rationals(GPS_ALT, [(int(round(abs(hgt) * 1000)), 1000)])
+    if hacc is not None and gps.get(GPS_H_POS_ERR, (0, 0))[0:2] == (5, 1):
+        _put_rationals(GPS_H_POS_ERR, [(int(round(hacc * 1000)), 1000)])
+    return True
+
+
+def _patch_xmp(data: bytearray, attrs: dict) -> bool:
+    """
+    Set drone-dji attributes in XMP segment data keeping its size.
+    Existing attributes are replaced, missing ones are added to rdf:Description
+    using whitespace padding of the packet. Returns False if there is no space.
+    """
+    head = len(XMP_HEADER)
+    xml = data[head:].decode("utf-8", errors="replace")
+    for k, v in attrs.items():
+        if k in XMP_ALIASES and '{}:{}="'.format(XMP_PREFIX, XMP_ALIASES[k]) in xml:
+            k = XMP_ALIASES[k]
+        key = "{}:{}".format(XMP_PREFIX, k)
+        pattern = re_compile(r'{}="[^"]*"'.format(escape(key)))
+        if pattern.search(xml):
+            xml = pattern.sub('{}="{}"'.format(key, v), xml, count=1)
+        else:
+            i = xml.find("<rdf:Description")
+            if i < 0:
+                return False
+            i += len("<rdf:Description")
+            if 'xmlns:{}='.format(XMP_PREFIX) not in xml:
+                xml = xml[:i] + ' xmlns:{}="{}"'.format(XMP_PREFIX, XMP_NS) + xml[i:]
+            xml = xml[:i] + ' {}="{}"'.format(key, v) + xml[i:]
+    body = xml.encode("utf-8")
+    diff = len(body) - (len(data) - head)
+    end = body.rfind(b"<?xpacket end")
+    if end >= 0:
+        pad_start = len(body[:end].rstrip(b" \t\r\n"))
+        # keep one whitespace after </x:xmpmeta>
+        if diff > end - pad_start - 1:
+            return False
+        if diff >= 0:
+            body = body[:end - diff] + body[end:]
+        else:
+            body = body[:end] + b" " * (-diff) + body[end:]
+    elif diff != 0:
+        return False
+    data[head:] = body
+    return True
+
+
+def write_gps(jpeg_file: str, lat: float, lon: float, hgt: float, acc: list = None) -> dict:
+    """
+    Write camera position into EXIF GPS tags and position and accuracy into XMP of a JPEG file (in place).
+    Height is written as ellipsoidal height to both GPSAltitude and drone-dji:AbsoluteAltitude.
+
+    Args
+    ----
+    jpeg_file: path of photo
+    lat, lon: latitude and longitude [deg]
+    hgt: ellipsoidal height [m]
+    acc: [north, east, up] accuracy [m] (optional)
+
+    Returns
+    -------
+    {"file": jpeg_file, "status": STATUS_*, "xmp": True if XMP is written}
+    """
+    ret = {"file": jpeg_file, "status": STATUS_OK, "xmp": False}
+    if not path.isfile(jpeg_file):
+        ret["status"] = STATUS_MISSING
+        return ret
+    try:
+        with open(jpeg_file, "r+b") as f:
+            exif, xmp = _read_app1_segments(f)
+            if exif is None:
+                ret["status"] = STATUS_NO_EXIF
+                return ret
+            hacc = None if acc is None else max(acc[0], acc[1])
+            if not _patch_exif_gps(exif[1], lat, lon, hgt, hacc):
+                ret["status"] = STATUS_NO_GPS
+                return ret
+            f.seek(exif[0])
+            f.write(exif[1])
+            if xmp is not None:
+                attrs = {"GpsLatitude": "{:+.9f}".format(lat), "GpsLongitude": "{:+.9f}".format(lon),
+                         "AbsoluteAltitude": "{:+.3f}".format(hgt)}
+                if acc is not None:
+                    attrs.update({"RtkStdLat": "{:.4f}".format(acc[0]), "RtkStdLon": "{:.4f}".format(acc[1]),
+                                  "RtkStdHgt": "{:.4f}".format(acc[2])})
+                if _patch_xmp(xmp[1], attrs):
+                    f.seek(xmp[0])
+                    f.write(xmp[1])
+                    ret["xmp"] = True
+    except Exception as e:
+        ret["status"], ret["error"] = STATUS_ERROR, str(e)
+    return ret
+
+
+def write_geotags(df_imgs: DataFrame, photo_dir: str, jobs: int = 8) -> dict:
+    """
+    Write camera positions of geotag table into photos in photo_dir on a thread pool.
+
+    Args
+    ----
+    df_imgs: DataFrame from geotag_info_from_posfile_and_mrkfile(..., formatted=False)
+    photo_dir: folder of photos (file names are "name" column)
+    jobs: number of threads
+
+    Returns
+    -------
+    summary: dict, counts of each status, list of files for each error status,
+             and "unmatched" (JPEG files in photo_dir which are not in df_imgs)
+    """
+    rows = list(zip(df_imgs["name"], df_imgs["lat"].astype(float), df_imgs["lon"].astype(float),
+                    df_imgs["hgt"].astype(float), df_imgs["north_acc"].astype(float),
+                    df_imgs["east_acc"].astype(float), df_imgs["up_acc"].astype(float)))
+
+    def _write(r):
+        return write_gps(path.join(photo_dir, r[0]), r[1], r[2], r[3], [r[4], r[5], r[6]])
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        results = list(executor.map(_write, rows))
+    summary = {"total": len(results), STATUS_OK: 0, "xmp": 0}
+    for r in results:
+        summary[r["status"]] = summary.get(r["status"], 0) + 1
+        summary["xmp"] += 1 if r["xmp"] else 0
+        if r["status"] != STATUS_OK:
+            summary.setdefault(r["status"] + "_files", []).append(path.basename(r["file"]))
+    names = set(df_imgs["name"])
+    summary["unmatched"] = sorted(n for n in listdir(photo_dir)
+                                  if n.lower().endswith((".jpg", ".jpeg")) and n not in names)
+    return summary
@@ -0,0 +1,284 @@
+"""
+多数のPOSファイルを時刻で検索できる列指向アーカイブにまとめるためのプログラム.
+
+アーカイブはディレクトリで、以下のファイルから構成されます.
+
+- index.json: 取り込んだPOSファイルごとの受信機名、時刻範囲、行の位置
+- <column>.bin, <column>.<generation>.bin: 各列の値を連結したバイナリ (numpy.memmap で読み込む)
+
+POSファイルごとに行は時刻順に並んでいるので、検索時は時刻範囲が重なるファイルだけを
+二分探索して、該当するエポックの行だけを読み出します.
+ファイルは受信機ごとに開始時刻順に並べ、終了時刻の累積最大値とともに保持して、
+時刻範囲が重なるファイルも二分探索で求めます.
+
+更新されたPOSファイルを取り込み直すと古い行は無効になります. 無効な行が全体の
+DEAD_RATIO を超えると、有効な行だけで列ファイルを書き直します(compact).
+書き直した列ファイルは新しい世代(generation)のファイル名で作り、index.json を置き換えてから
+古い世代のファイルを削除するので、compact が中断してもアーカイブは壊れません.
+"""
+from bisect import bisect_left, bisect_right
+from glob import glob
+from json import dump, load as json_load
+from os import path, makedirs, remove, replace, stat
+from typing import Dict, List
+from numpy import array, dtype, memmap, searchsorted, concatenate, ndarray, empty, full, argsort
+
+import xgnss.rinex_pos as rnx_pos
+
+COLUMNS = {"t": "f8", "X": "f8", "Y": "f8", "Z": "f8", "Q": "i1", "nsat": "i2",
+           "cvx": "f8", "cvy": "f8", "cvz": "f8", "cvxy": "f8", "cvyz": "f8", "cvzx": "f8",
+           "age": "f4", "ratio": "f4"}
+INDEX_FILE = "index.json"
+DEAD_RATIO = 0.25 # compact() is run by ingest() if removed rows exceed this ratio
+
+
+def _receiver_name(pos_file: str) -> str:
+    """
+    Default receiver name: first 4 characters of the file name (RINEX station name).
+    """
+    return path.basename(pos_file)[:4]
+
+
+class PosArchive:
+    """
+    Time-indexed archive of RTKLIB solutions.
+
+    archive = PosArchive("archive_dir")
+    archive.ingest(glob("pos/*.pos"))
+    d = archive.query(t1, t2, receiver="3012")
+    """
+
+    def __init__(self, archive_dir: str):
+        self.archive_dir = archive_dir
+        makedirs(archive_dir, exist_ok=True)
+        self._files = []
+        self._generation = 0
+        index_file = path.join(archive_dir, INDEX_FILE)
+        if path.isfile(index_file):
+            with open(index_file) as f:
+                index = json_load(f)
+            self._files = index["files"]
+            self._generation = index.get("generation", 0)
+        self._remove_stale_columns()
+        self._build_lookup()
+
+    def _remove_stale_columns(self):
+        """
+        Remove column files of other generations left by an interrupted compact().
+        """
+        current = set(self._column_file(k) for k in COLUMNS)
+        for k in COLUMNS:
+            for f in glob(path.join(self.archive_dir, k + ".bin")) + glob(path.join(self.archive_dir, k + ".*.bin")):
+                if f not in current:
+                    remove(f)
+
+    def _build_lookup(self):
+        """
+        Live entries per receiver sorted by t_start, with running maximum of t_end.
+        """
+        self._lookup = {}
+        for e in sorted(self._files, key=lambda e: e["t_start"]):
+            if e.get("removed", False):
+                continue
+            entries, t_start, t_end_max = self._lookup.setdefault(e["receiver"], ([], [], []))
+            entries.append(e)
+            t_start.append(e["t_start"])
+            t_end_max.append(max(t_end_max[-1], e["t_end"]) if t_end_max else e["t_end"])
+
+    def _overlapping(self, t1: float, t2: float, receiver: str = None) -> List[dict]:
+        """
+        Live entries whose time range overlaps [t1, t2], found by bisection.
+        """
+        receivers = list(self._lookup) if receiver is None else [receiver]
+        ret = []
+        for r in receivers:
+            if r not in self._lookup:
+                continue
+            entries, t_start, t_end_max = self._lookup[r]
+            # entries before k1 end before t1, entries from k2 start after t2
+            k1, k2 = bisect_left(t_end_max, t1), bisect_right(t_start, t2)
+            ret += [e for e in entries[k1:k2] if e["t_end"] >= t1]
+        return ret
+
+    def _column_file(self, k: str, generation: int = None) -> str:
+        generation = self._generation if generation is None else generation
+        if generation == 0:
+            return path.join(self.archive_dir, k + ".bin")
+        return path.join(self.archive_dir, "{}.{}.bin".format(k, generation))
+
+    @property
+    def n_rows(self) -> int:
+        return sum(e["n"] for e in self._files)
+
+    def files(self, receiver: str = None) -> List[dict]:
+        """
+        Index entries (source, receiver, t_start, t_end, row, n) of live files.
+        """
+        if receiver is not None:
+            return list(self._lookup[receiver][0]) if receiver in self._lookup else []
+        return [e for e in self._files if not e.get("removed", False)]
+
+    @property
+    def n_dead_rows(self) -> int:
+        return sum(e["n"] for e in self._files if e.get("removed", False))
+
+    def _save_index(self):
+        tmp = path.join(self.archive_dir, INDEX_FILE + ".tmp")
+        with open(tmp, "w") as f:
+            dump({"columns": COLUMNS, "generation": self._generation, "files": self._files}, f, indent=1)
+        replace(tmp, path.join(self.archive_dir, INDEX_FILE))
+
+    def ingest(self, pos_files: List[str], receiver: str = None) -> int:
+        """
+        Add POS files to the archive. Files already ingested with the same size and mtime are skipped.
+        If a file has been changed, its old rows are removed from the index and the new rows are added.
+
+        Args
+        ----
+        pos_files: list of POS file paths
+        receiver: receiver name (default: first 4 characters of each file name)
+
+        Returns
+        -------
+        number of ingested files
+        """
+        n_rows = self.n_rows
+        # drop rows written after the last saved index (interrupted ingest)
+        for k in COLUMNS:
+            size = n_rows * dtype(COLUMNS[k]).itemsize
+            with open(self._column_file(k), "ab") as f:
+                if f.tell() < size:
+                    raise ValueError("pos_archive: {} is shorter than the index ({} < {} bytes)".format(
+                        self._column_file(k), f.tell(), size))
+                f.truncate(size)
+        known = {e["source"]: e for e in self.files()}
+        n_files = 0
+        for pos_file in sorted(pos_files):
+            src = path.abspath(pos_file)
+            st = stat(src)
+            if src in known and known[src]["size"] == st.st_size and known[src]["mtime"] == st.st_mtime:
+                continue
+            epochs = rnx_pos.load(src)
+            if len(epochs) == 0:
+                continue
+            t, p_xyz, P_xyz = rnx_pos.to_arrays(epochs)
+            cols = {"t": t, "X": p_xyz[:, 0], "Y": p_xyz[:, 1], "Z": p_xyz[:, 2],
+                    "cvx": P_xyz[:, 0, 0], "cvy": P_xyz[:, 1, 1], "cvz": P_xyz[:, 2, 2],
+                    "cvxy": P_xyz[:, 0, 1], "cvyz": P_xyz[:, 1, 2], "cvzx": P_xyz[:, 2, 0]}
+            for k in ["Q", "nsat", "age", "ratio"]:
+                cols[k] = array([e[k] for e in epochs])
+            i_sort = argsort(t, kind="stable")
+            for k in COLUMNS:
+                with open(self._column_file(k), "ab") as f:
+                    f.write(cols[k][i_sort].astype(COLUMNS[k]).tobytes())
+            if src in known:
+                known[src]["removed"] = True
+            entry = {"source": src, "receiver": receiver or _receiver_name(src),
+                     "size": st.st_size, "mtime": st.st_mtime,
+                     "t_start": float(t[i_sort[0]]), "t_end": float(t[i_sort[-1]]),
+                     "row": n_rows, "n": len(t)}
+            self._files.append(entry)
+            known[src] = entry
+            n_rows += len(t)
+            n_files += 1
+        self._save_index()
+        self._build_lookup()
+        if n_rows > 0 and self.n_dead_rows > DEAD_RATIO * n_rows:
+            self.compact()
+        return n_files
+
+    def compact(self) -> int:
+        """
+        Rewrite column files with the rows of live files only and drop removed entries from the index.
+        New column files are written with the next generation number and index.json is replaced
+        before the old column files are removed.
+
+        Returns
+        -------
+        number of removed rows
+        """
+        live = self.files()
+        n_dead = self.n_dead_rows
+        if n_dead == 0:
+            return 0
+        generation = self._generation + 1
+        for k in COLUMNS:
+            mm = self._memmap(k)
+            with open(self._column_file(k, generation), "wb") as f:
+                for e in live:
+                    f.write(array(mm[e["row"]:e["row"] + e["n"]]).tobytes())
+            del mm
+        old = [self._column_file(k) for k in COLUMNS]
+        row = 0
+        for e in live:
+            e["row"] = row
+            row += e["n"]
+        self._files = live
+        self._generation = generation
+        self._save_index()
+        for f in old:
+            remove(f)
+        self._build_lookup()
+        return n_dead
+
+    def ingest_dir(self, pos_dir: str, receiver: str = None, pattern: str = "*.pos") -> int:
+        """
+        Add all POS files in a directory. See ingest().
+        """
+        return self.ingest(glob(path.join(pos_dir, pattern)), receiver)
+
+    def _memmap(self, k: str) -> ndarray:
+        n_rows = self.n_rows
+        if n_rows == 0:
+            return empty(0, dtype=COLUMNS[k])
+        return memmap(self._column_file(k), dtype=COLUMNS[k], mode="r", shape=(n_rows,))
+
+    def query(self, t1: float, t2: float, receiver: str = None, columns: List[str] = None) -> Dict[str, ndarray]:
+        """
+        Epochs in [t1, t2] (unix time [s]).
+
+        Args
+        ----
+        t1, t2: time range, unix time [s]
+        receiver: receiver name (None: all receivers)
+        columns: column names to read (None: all, see COLUMNS)
+
+        Returns
+        -------
+        dict of column name and ndarray, sorted by time. "receiver" column is added
+        when receiver is not specified.
+        """
+        columns = list(COLUMNS) if columns is None else columns
+        entries = self._overlapping(t1, t2, receiver)
+        t_all = self._memmap("t")
+        slices = []
+        for e in entries:
+            t = t_all[e["row"]:e["row"] + e["n"]]
+            i1, i2 = searchsorted(t, t1, side="left"), searchsorted(t, t2, side="right")
+            if i2 > i1:
+                slices.append((e, e["row"] + i1, e["row"] + i2))
+        ret = {}
+        for k in columns:
+            mm = t_all if k == "t" else self._memmap(k)
+            ret[k] = concatenate([array(mm[r1:r2]) for _, r1, r2 in slices]) if slices else empty(0, dtype=COLUMNS[k])
+        if receiver is None:
+            ret["receiver"] = concatenate([full(r2 - r1, e["receiver"], dtype=object) for e, r1, r2 in slices]) \
+                if slices else empty(0, dtype=object)
+        if len(slices) > 1:
+            t = ret["t"] if "t" in ret else concatenate([array(t_all[r1:r2]) for _, r1, r2 in slices])
+            i_sort = argsort(t, kind="stable")
+            ret = {k: v[i_sort] for k, v in ret.items()}
+        return ret
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("archive_dir", help="archive directory", type=str)
+    parser.add_argument("pos_dir", help="directory of POS files to ingest", type=str)
+    parser.add_argument("--receiver", help="receiver name (default: first 4 characters of file name)", default=None)
+    parser.add_argument("--pattern", help="file name pattern", default="*.pos")
+    args = parser.parse_args()
+    archive = PosArchive(args.archive_dir)
+    n = archive.ingest_dir(args.pos_dir, args.receiver, args.pattern)
+    print("ingested: {} files, archive: {} files ({} epochs)".format(n, len(archive.files()), archive.n_rows))
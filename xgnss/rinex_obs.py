@@ -0,0 +1,280 @@
+"""
+RINEX (version 3) 観測値ファイルを読むためのプログラム.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from os import SEEK_END
+from typing import Tuple
+
+TAIL_BYTES = 1 << 16 # size of the file tail read to find the last epoch
+SNR_BINS = 70 # SNR histogram of 1 dB-Hz bins (0 - 69 dB-Hz)
+SNR_WEAK = 28.0 # [dB-Hz] satellites with lower mean SNR are excluded
+SLIP_RATE_MAX = 0.05 # satellites with more cycle slips (LLI) per epoch are excluded
+GAP_RATE_MAX = 0.02 # satellites with more data gaps per epoch are excluded
+MIN_EPOCHS = 10 # satellites observed in less epochs are not evaluated
+SNR_MASK_PERCENTILE = 10.0 # snrmask is set to this percentile of L1 SNR of the satellites not excluded
+# snrmask is clipped to this range [dB-Hz]. The lower limit is below the default snrmask (30) of
+# camera_geotagging_by_ppk on purpose: with small antennas (e.g. on drones) L1 SNR of healthy satellites
+# is often lower, and a mask of 30 would drop many of their low elevation observations.
+SNR_MASK_RANGE = (25, 40)
+
+
+def _epoch_datetime(v: list) -> datetime:
+    """
+    datetime from [year, month, day, hour, minute, second] in GPS time.
+    Time is treated as UTC without leap seconds, same as rinex_pos and *.MRK.
+    """
+    sc = float(v[5])
+    return datetime(int(v[0]), int(v[1]), int(v[2]), int(v[3]), int(v[4]), int(sc),
+                    int(round((sc % 1) * 1E6)) % 1000000, tzinfo=timezone.utc)
+
+
+def read_header(obs_file: str) -> dict:
+    """
+    Read header of RINEX observation file.
+
+    Returns
+    -------
+    header: dict
+        version, marker, rcv, ant, ant_d ([E, N, U] [m]), pos_xyz ([X, Y, Z] [m]),
+        obs_types ({system: [obs code]}), interval [s], time_first, time_last (datetime or None)
+    """
+    hdr = {"version": 0.0, "marker": "", "rcv": "", "ant": "", "ant_d": [0.0, 0.0, 0.0],
+           "pos_xyz": [0.0, 0.0, 0.0], "obs_types": {}, "interval": 0.0, "time_first": None, "time_last": None}
+    sys_cont = None
+    with open(obs_file, encoding="ascii", errors="replace") as f:
+        for l in f:
+            label = l[60:].strip()
+            if label == "END OF HEADER":
+                break
+            elif label == "RINEX VERSION / TYPE":
+                hdr["version"] = float(l[0:9])
+            elif label == "MARKER NAME":
+                hdr["marker"] = l[0:60].strip()
+            elif label == "REC # / TYPE / VERS":
+                hdr["rcv"] = l[20:40].strip()
+            elif label == "ANT # / TYPE":
+                hdr["ant"] = l[20:40].strip()
+            elif label == "APPROX POSITION XYZ":
+                hdr["pos_xyz"] = [float(l[0:14]), float(l[14:28]), float(l[28:42])]
+            elif label == "ANTENNA: DELTA H/E/N":
+                h, e, n = float(l[0:14]), float(l[14:28]), float(l[28:42])
+                hdr["ant_d"] = [e, n, h]
+            elif label == "SYS / # / OBS TYPES":
+                if l[0] != " ":
+                    sys_cont = l[0]
+                    hdr["obs_types"][sys_cont] = []
+                hdr["obs_types"][sys_cont] += l[7:60].split()
+            elif label == "INTERVAL":
+                hdr["interval"] = float(l[0:10])
+            elif label == "TIME OF FIRST OBS":
+                hdr["time_first"] = _epoch_datetime(l[0:43].split())
+            elif label == "TIME OF LAST OBS":
+                hdr["time_last"] = _epoch_datetime(l[0:43].split())
+    return hdr
+
+
+def _last_epoch(obs_file: str) -> datetime:
+    """
+    Time of the last epoch record ('>' line) found in the tail of the file.
+    """
+    with open(obs_file, "rb") as f:
+        f.seek(0, SEEK_END)
+        size = f.tell()
+        n = TAIL_BYTES
+        while True:
+            f.seek(max(size - n, 0))
+            lines = f.read().decode("ascii", errors="replace").splitlines()
+            for l in reversed(lines):
+                if l.startswith(">"):
+                    return _epoch_datetime(l[1:].split()[0:6])
+            if n >= size:
+                return None
+            n *= 4
+
+
+def epoch_range(obs_file: str, hdr: dict = None) -> Tuple[datetime, datetime]:
+    """
+    First and last epoch time of the observation file.
+    TIME OF LAST OBS is used if it is in the header, otherwise the tail of the file is read.
+    """
+    hdr = hdr if hdr is not None else read_header(obs_file)
+    t_last = hdr["time_last"] if hdr["time_last"] is not None else _last_epoch(obs_file)
+    return hdr["time_first"], t_last
+
+
+def scan(obs_file: str, t_start: float = None, t_end: float = None) -> dict:
+    """
+    Scan observation file in one pass and collect statistics per satellite and signal.
+    Memory does not depend on the file length.
+    Only epochs in [t_start, t_end] (unix time [s], None: no limit) are counted,
+    so that statistics of a long base station file cover the flight only.
+
+    Returns
+    -------
+    result: dict
+        file, marker, n_epochs, interval [s], t_first, t_last [unix time],
+        sats: {sv: {n, n_phase, slips, gaps, first, last, snr_sum, snr_n, hist}}
+              (snr_sum, snr_n: snr of the first S code of the system, hist: {S code: SNR histogram}),
+        signals: {"G S1C": {n, hist}} (hist: number of observations in 1 dB-Hz bins)
+    """
+    hdr = read_header(obs_file)
+    obs_types = hdr["obs_types"]
+    # column of each observation in the satellite record
+    idx_phase = {s: [i for i, c in enumerate(v) if c[0] == "L"] for s, v in obs_types.items()}
+    idx_snr = {s: [i for i, c in enumerate(v) if c[0] == "S"] for s, v in obs_types.items()}
+    sats, signals = {}, {}
+    n_epochs, t_first, t_last, dt_min = 0, None, None, None
+    with open(obs_file, encoding="ascii", errors="replace") as f:
+        for l in f:
+            if l[60:73] == "END OF HEADER":
+                break
+        n_skip = 0
+        t = None
+        for l in f:
+            if n_skip > 0: # event records
+                n_skip -= 1
+                continue
+            if l[0] == ">":
+                v = l[1:].split()
+                if int(v[6]) > 1: # event flag
+                    n_skip = int(v[7])
+                    t = None
+                    continue
+                t0, t = t, _epoch_datetime(v[0:6]).timestamp()
+                if t_end is not None and t > t_end: # epochs are in time order
+                    break
+                if t_start is not None and t < t_start:
+                    t = None
+                    continue
+                if t0 is not None and t > t0:
+                    dt_min = t - t0 if dt_min is None else min(dt_min, t - t0)
+                t_first = t if t_first is None else t_first
+                t_last = t
+                n_epochs += 1
+                continue
+            if t is None or len(l) < 4:
+                continue
+            sv, sys = l[0:3].replace(" ", "0"), l[0]
+            if sys not in obs_types:
+                continue
+            st = sats.get(sv)
+            if st is None:
+                st = sats[sv] = {"n": 0, "n_phase": 0, "slips": 0, "gaps": 0, "first": t, "last": t,
+                                 "snr_sum": 0.0, "snr_n": 0, "hist": {}}
+            elif t - st["last"] > 1.5 * (dt_min or hdr["interval"] or 1.0):
+                st["gaps"] += 1
+            st["n"] += 1
+            st["last"] = t
+            has_phase = False
+            for i in idx_phase[sys]:
+                fld = l[3 + 16 * i: 3 + 16 * (i + 1)]
+                if fld[0:14].strip() == "":
+                    continue
+                has_phase = True
+                lli = fld[14:15]
+                if lli.strip() != "" and int(lli) & 1:
+                    st["slips"] += 1
+            st["n_phase"] += 1 if has_phase else 0
+            for j, i in enumerate(idx_snr[sys]):
+                fld = l[3 + 16 * i: 3 + 16 * i + 14].strip()
+                if fld == "":
+                    continue
+                snr = float(fld)
+                code = obs_types[sys][i]
+                key = "{} {}".format(sys, code)
+                sg = signals.get(key)
+                if sg is None:
+                    sg = signals[key] = {"n": 0, "hist": [0] * SNR_BINS}
+                k_bin = min(max(int(snr), 0), SNR_BINS - 1)
+                sg["n"] += 1
+                sg["hist"][k_bin] += 1
+                if code not in st["hist"]:
+                    st["hist"][code] = [0] * SNR_BINS
+                st["hist"][code][k_bin] += 1
+                if j == 0:
+                    st["snr_sum"] += snr
+                    st["snr_n"] += 1
+    return {"file": obs_file, "marker": hdr["marker"], "n_epochs": n_epochs,
+            "interval": dt_min or hdr["interval"], "t_first": t_first, "t_last": t_last,
+            "sats": sats, "signals": signals}
+
+
+def scan_files(obs_files: list, jobs: int = 1, t_start: float = None, t_end: float = None) -> list:
+    """
+    scan() several observation files in parallel processes.
+    Call from the main thread: worker processes are forked.
+    """
+    n = len(obs_files)
+    if jobs <= 1 or n <= 1:
+        return [scan(f, t_start, t_end) for f in obs_files]
+    with ProcessPoolExecutor(max_workers=min(jobs, n)) as executor:
+        return list(executor.map(scan, obs_files, [t_start] * n, [t_end] * n))
+
+
+def _percentile(hist: list, q: float) -> float:
+    n = sum(hist)
+    if n == 0:
+        return None
+    c = 0
+    for i, h in enumerate(hist):
+        c += h
+        if c >= n * q / 100.0:
+            return float(i)
+    return float(len(hist) - 1)
+
+
+def suggest_options(scans: list) -> dict:
+    """
+    Suggest RTKLIB options (exclude_sats and snrmask of _create_conffile) from scan() results.
+    A satellite is excluded if it is weak, has frequent cycle slips or gaps in any of the files.
+    snrmask is the low percentile of SNR of L1 signals of the satellites which are not excluded,
+    so that a few weak satellites do not lower the mask.
+
+    Returns
+    -------
+    {"exclude_sats": [sv], "snrmask": int, "reasons": {sv: [reason]}}
+    """
+    reasons = {}
+    for sc in scans:
+        name = sc["marker"] or sc["file"]
+        for sv, st in sc["sats"].items():
+            if st["n"] < MIN_EPOCHS:
+                continue
+            r = []
+            if st["snr_n"] > 0 and st["snr_sum"] / st["snr_n"] < SNR_WEAK:
+                r.append("{}: mean SNR {:.1f}".format(name, st["snr_sum"] / st["snr_n"]))
+            if st["n_phase"] > 0 and st["slips"] / st["n_phase"] > SLIP_RATE_MAX:
+                r.append("{}: {} slips / {} epochs".format(name, st["slips"], st["n_phase"]))
+            if st["gaps"] / st["n"] > GAP_RATE_MAX:
+                r.append("{}: {} gaps / {} epochs".format(name, st["gaps"], st["n"]))
+            if len(r) > 0:
+                reasons.setdefault(sv, []).extend(r)
+    hist = [0] * SNR_BINS
+    for sc in scans:
+        for sv, st in sc["sats"].items():
+            if sv in reasons:
+                continue
+            for code, h in st["hist"].items():
+                if code.startswith("S1"):
+                    hist = [a + b for a, b in zip(hist, h)]
+    p = _percentile(hist, SNR_MASK_PERCENTILE)
+    snrmask = 30 if p is None else int(min(max(p, SNR_MASK_RANGE[0]), SNR_MASK_RANGE[1]))
+    return {"exclude_sats": sorted(reasons), "snrmask": snrmask, "reasons": reasons}
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Scan RINEX observation files and suggest excluded satellites and snrmask")
+    parser.add_argument("obs_files", help="RINEX observation files", nargs="+", type=str)
+    parser.add_argument("--jobs", help="number of files scanned in parallel", default=4, type=int)
+    args = parser.parse_args()
+    scans = scan_files(args.obs_files, args.jobs)
+    for sc in scans:
+        print("{}: {} epochs, {} sats, interval {} s".format(sc["file"], sc["n_epochs"], len(sc["sats"]), sc["interval"]))
+        for key, sg in sorted(sc["signals"].items()):
+            print("  {}: {} obs, SNR p10 {} / p50 {}".format(key, sg["n"], _percentile(sg["hist"], 10.0), _percentile(sg["hist"], 50.0)))
+    suggested = suggest_options(scans)
+    for sv, r in suggested["reasons"].items():
+        print("exclude {}: {}".format(sv, ", ".join(r)))
+    print("exclude_sats={} snrmask={}".format(" ".join(suggested["exclude_sats"]), suggested["snrmask"]))
@@ -2,22 +2,25 @@
 RTKLIBで用いられているPOSファイルを読み書きするためのプログラム.
 """
 import xgnss.calc_xyz  as calc_xyz
-from numpy import floor, deg2rad, rad2deg, sign, abs, sqrt, array
+from numpy import floor, deg2rad, rad2deg, sign, abs, sqrt, array, zeros, ndarray
 from datetime import datetime, timezone
 from pandas import DataFrame, Series, to_datetime
 from os import path
+from typing import Tuple
 
 _TIME_T_ORIGIN = 315964800 # 1980,Jan,6, 00:00:00
 
-def load(pos_file:str, param = {}) -> list:
+def load(pos_file:str, param = {}, index = None) -> list:
     '''
     Args
     ----
     pof_file: file path
     parms = {'date': 'utc' or 'gps', 'pos_type': 'llh' or 'xyz' or 'enu', 'base_pos_xyz': [x,y,z]}
+    index: fix_index.FixIndex, if given, epochs are also added to the index while loading
     '''
     line_counter = 0
     pos_format = 'llh' # 0: llh, 1:enu, 2:xyz
+    p_base_xyz = None
     if 'base_pos_xyz' in param:
         p_base_xyz = param['base_pos_xyz']
     if 'pos_type' in param:
@@ -48,17 +51,21 @@ def load(pos_file:str, param = {}) -> list:
         if not line:
             break
         try:
-            pos_epoch,is_valid = read_pos(line, pos_format)
-            if is_valid: pos_epoch_list.append(pos_epoch)
+            pos_epoch,is_valid = read_pos(line, pos_format, p_base_xyz)
+            if is_valid:
+                pos_epoch_list.append(pos_epoch)
+                if index is not None:
+                    index.append(pos_epoch['datetime'].timestamp(), pos_epoch['Q'], pos_epoch['ratio'], pos_epoch['nsat'])
         except Exception as e:
             print(e)
             pass
     return pos_epoch_list
 
 
-def read_pos(line: str, pos_format: str):
+def read_pos(line: str, pos_format: str, p_base_xyz: list = None):
     '''
     Parse one line of POS file in specific format.
+    p_base_xyz: [x,y,z] of the base station, required for 'enu' (e/n/u-baseline) format.
     '''
     itm = line[:-1].split()
 #00000000001111111111222222222233333333334444444444555555555566666666667777777777888888888899999999990000000000111111111122222222223333333333
@@ -91,29 +98,38 @@ def read_pos(line: str, pos_format: str):
     # Read position
     #
     x = []
-    sdx,sdy,sdz,sdxy,sdeyz,sdzx = 0.0, 0.0, 0.0, 0.0, 0.0, 0.0
     if pos_format == 'llh':
         lat,lon,hgt = float(itm[2]),float(itm[3]),float(itm[4])
         sdn,sde,sdu,sdne,sdeu,sdun = float(itm[7]),float(itm[8]),float(itm[9]),float(itm[10]),float(itm[11]),float(itm[12])
         x   = calc_xyz.llh2xyz([deg2rad(lat), deg2rad(lon), hgt])
-        # TODO: !!!!!! covariance conversion !!!!!!!
-        sdx,sdy,sdz,sdxy,sdeyz,sdzx = sdn,sde,sdu,sdne,sdeu,sdun
+        Q_enu = _cov_matrix(sde, sdn, sdu, sdne, sdun, sdeu)
+        P_xyz = calc_xyz.cov_enu2xyz(Q_enu, deg2rad(lat), deg2rad(lon))
     elif pos_format == 'enu':
+        if p_base_xyz is None:
+            print('rinex_pos.read_pos: base_pos_xyz is required for e/n/u-baseline')
+            return None, False
+        # RTKLIB writes e/n/u-baseline as sde,sdn,sdu,sden,sdnu,sdue
+        # ENU frame of the baseline is defined at the base station
         enu_e,enu_n,enu_u = float(itm[2]),float(itm[3]),float(itm[4])
-        sdn,sde,sdu,sdne,sdeu,sdun = float(itm[7]),float(itm[8]),float(itm[9]),float(itm[10]),float(itm[11]),float(itm[12])
-        x = calc_xyz.enu2xyz(array([enu_e,enu_n,enu_u]))
-        # TODO: !!!!!! covariance conversion !!!!!!
-        sdx,sdy,sdz,sdxy,sdeyz,sdzx = sdn,sde,sdu,sdne,sdeu,sdun
+        sde,sdn,sdu,sden,sdnu,sdue = float(itm[7]),float(itm[8]),float(itm[9]),float(itm[10]),float(itm[11]),float(itm[12])
+        base_llh = calc_xyz.xyz2llh(p_base_xyz)
+        x = calc_xyz.enu2xyz(array([enu_e,enu_n,enu_u]), array(p_base_xyz), base_llh[0], base_llh[1])
+        Q_enu = _cov_matrix(sde, sdn, sdu, sden, sdnu, sdue)
+        P_xyz = calc_xyz.cov_enu2xyz(Q_enu, base_llh[0], base_llh[1])
     elif pos_format == 'xyz':
         x = float(itm[2]),float(itm[3]),float(itm[4])
-        sdx,sdy,sdz,sdxy,sdeyz,sdzx = float(itm[7]),float(itm[8]),float(itm[9]),float(itm[10]),float(itm[11]),float(itm[12])
+        sdx,sdy,sdz,sdxy,sdyz,sdzx = float(itm[7]),float(itm[8]),float(itm[9]),float(itm[10]),float(itm[11]),float(itm[12])
+        P_xyz = _cov_matrix(sdx, sdy, sdz, sdxy, sdyz, sdzx)
     else:
         is_valid = False
 
     pos_epoch['Q'], pos_epoch['nsat'] = int(itm[5]), int(itm[6])
     pos_epoch['X'], pos_epoch['Y'], pos_epoch['Z'] = x[0], x[1], x[2]
-    pos_epoch['sdx'], pos_epoch['sdy'], pos_epoch['sdz'], pos_epoch['sdxy'], pos_epoch['sdyz'], pos_epoch['sdzx'] \
-        = sdx, sdy, sdz, sdxy, sdeyz, sdzx
+    pos_epoch['cvx'], pos_epoch['cvy'], pos_epoch['cvz'] = P_xyz[0, 0], P_xyz[1, 1], P_xyz[2, 2]
+    pos_epoch['cvxy'], pos_epoch['cvyz'], pos_epoch['cvzx'] = P_xyz[0, 1], P_xyz[1, 2], P_xyz[2, 0]
+    pos_epoch['sdx'], pos_epoch['sdy'], pos_epoch['sdz'] = sqrt(P_xyz[0, 0]), sqrt(P_xyz[1, 1]), sqrt(P_xyz[2, 2])
+    pos_epoch['sdxy'], pos_epoch['sdyz'], pos_epoch['sdzx'] \
+        = _sqvar(P_xyz[0, 1]), _sqvar(P_xyz[1, 2]), _sqvar(P_xyz[2, 0])
     #
     # Read additional
     #
@@ -121,6 +137,46 @@ def read_pos(line: str, pos_format: str):
     return pos_epoch, is_valid
 
 
+def _sqvar(covar: float) -> float:
+    """
+    Signed square root of covariance, same as sqvar() in RTKLIB solution.c
+    """
+    return sign(covar) * sqrt(abs(covar))
+
+
+def _cov_matrix(sd1, sd2, sd3, sd12, sd23, sd31) -> ndarray:
+    """
+    Build 3x3 covariance from standard deviations in POS file.
+    Cross terms are signed square root of covariance (see _sqvar).
+    """
+    c12, c23, c31 = sign(sd12) * sd12**2, sign(sd23) * sd23**2, sign(sd31) * sd31**2
+    return array([
+        [sd1**2,    c12,    c31],
+        [   c12, sd2**2,    c23],
+        [   c31,    c23, sd3**2]])
+
+
+def to_arrays(pos_epoch_list: list) -> Tuple[ndarray, ndarray, ndarray]:
+    """
+    Convert list of epochs returned by load() into arrays for batched computation.
+
+    Returns
+    -------
+    t[N]: unix time [s]
+    p_xyz[N,3]: position in ECEF [m]
+    P_xyz[N,3,3]: covariance of position in ECEF [m^2]
+    """
+    n = len(pos_epoch_list)
+    t, p_xyz, P_xyz = zeros(n), zeros((n, 3)), zeros((n, 3, 3))
+    for i, e in enumerate(pos_epoch_list):
+        t[i] = e['gpsweek'] * 604800 + e['gpstow'] + _TIME_T_ORIGIN
+        p_xyz[i] = e['X'], e['Y'], e['Z']
+        P_xyz[i] = [[e['cvx'],  e['cvxy'], e['cvzx']],
+                    [e['cvxy'], e['cvy'],  e['cvyz']],
+                    [e['cvzx'], e['cvyz'], e['cvz']]]
+    return t, p_xyz, P_xyz
+
+
 def load_df(pos_file: path):
     """
     *.pos ファイル (主にRTKLIBの出力ファイル) を読んで pandas DataFrame を返す